@@ -1,13 +1,29 @@
+import os
+import numpy as np
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from model import compute_embedding
+from batcher import DynamicBatcher
+from cache import EmbeddingCache, embed_with_cache
+from model import compute_embeddings
 
 app = FastAPI(
     title="SIE OSS Embedding Engine",
     description="Lightweight OSS embedding service for SIE RAG pipeline",
-    version="0.1"
+    version="0.1",
+    default_response_class=ORJSONResponse,
 )
 
+# Coalesce concurrent requests into one compute_embeddings call
+batcher = DynamicBatcher(
+    compute_embeddings,
+    max_batch_size=int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "64")),
+    timeout_ms=float(os.getenv("EMBEDDING_BATCH_TIMEOUT_MS", "5")),
+)
+
+# Repeated texts are served from an in-process LRU
+cache = EmbeddingCache(maxsize=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")))
+
 class EmbeddingRequest(BaseModel):
     texts: list[str]
 
@@ -16,8 +32,10 @@ class EmbeddingResponse(BaseModel):
 
 @app.post("/v1/embeddings", response_model=EmbeddingResponse)
 async def embeddings(req: EmbeddingRequest):
-    embs = [compute_embedding(t) for t in req.texts]
-    return EmbeddingResponse(embeddings=embs)
+    if not req.texts:
+        return ORJSONResponse({"embeddings": []})
+    embs = await embed_with_cache(cache, req.texts, batcher.submit)
+    return ORJSONResponse({"embeddings": np.stack(embs)})
 
 @app.get("/health")
 async def health():
@@ -0,0 +1,95 @@
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class DynamicBatcher:
+    """
+    Coalesces concurrent embedding requests into a single batch call.
+
+    Callers `await submit(texts)`; texts arriving within `timeout_ms` of
+    the first pending request (up to `max_batch_size`) are passed to
+    `fn` together, and each caller gets back its own slice of the result.
+    `fn` takes a list of distinct texts and returns a sequence (list or
+    ndarray) with one row per text; duplicates are folded before the call
+    and expanded again afterwards. It runs in a worker thread so the event
+    loop keeps accepting requests (and filling the next batch) meanwhile.
+    If a merged batch fails, each request in it is retried on its own, so
+    only the requests that fail alone receive the exception.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[List[str]], Sequence[Any]],
+        max_batch_size: int = 64,
+        timeout_ms: float = 5.0,
+    ):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout_ms / 1000.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, texts: List[str]) -> Sequence[Any]:
+        if not texts:
+            return []
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((texts, fut))
+        return await fut
+
+    async def _collect(self) -> List[Tuple[List[str], asyncio.Future]]:
+        pending = [await self._queue.get()]
+        size = len(pending[0][0])
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while size < self.max_batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            pending.append(item)
+            size += len(item[0])
+        return pending
+
+    async def _compute(self, texts: List[str]) -> np.ndarray:
+        # Identical texts (within or across requests) are embedded once
+        positions: Dict[str, int] = {}
+        inverse = np.array([positions.setdefault(t, len(positions)) for t in texts])
+        results = await asyncio.to_thread(self.fn, list(positions))
+        return np.asarray(results)[inverse]
+
+    async def _run(self):
+        while True:
+            pending = await self._collect()
+            texts = [t for req_texts, _ in pending for t in req_texts]
+            try:
+                results = await self._compute(texts)
+            except Exception as e:
+                if len(pending) == 1:
+                    _, fut = pending[0]
+                    if not fut.done():
+                        fut.set_exception(e)
+                    continue
+                # One request can poison a merged batch; rerun each request
+                # alone so only the one(s) that actually fail see the error.
+                for req_texts, fut in pending:
+                    if fut.done():
+                        continue
+                    try:
+                        fut.set_result(await self._compute(req_texts))
+                    except Exception as req_error:
+                        fut.set_exception(req_error)
+                continue
+            offset = 0
+            for req_texts, fut in pending:
+                end = offset + len(req_texts)
+                if not fut.done():
+                    fut.set_result(results[offset:end])
+                offset = end
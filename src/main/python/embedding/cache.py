@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Sequence
+
+import numpy as np
+import xxhash
+
+
+class EmbeddingCache:
+    """
+    Thread-safe in-process LRU of embedding vectors keyed by xxh3 of the text.
+
+    Embeddings are deterministic for a given model, so entries are never
+    invalidated; they are only evicted when `maxsize` is exceeded.
+    A `maxsize` of 0 disables the cache.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[int, np.ndarray]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _key(text: str) -> int:
+        return xxhash.xxh3_128_intdigest(text.encode("utf-8"))
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        if self.maxsize <= 0:
+            return [None] * len(texts)
+        out = []
+        with self._lock:
+            for text in texts:
+                key = self._key(text)
+                vec = self._entries.get(key)
+                if vec is not None:
+                    self._entries.move_to_end(key)
+                out.append(vec)
+        return out
+
+    def put_many(self, texts: List[str], vectors: Sequence[np.ndarray]):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            for text, vec in zip(texts, vectors):
+                key = self._key(text)
+                vec = np.array(vec)
+                vec.setflags(write=False)
+                self._entries[key] = vec
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+async def embed_with_cache(
+    cache: EmbeddingCache,
+    texts: List[str],
+    compute: Callable[[List[str]], Awaitable[Sequence[np.ndarray]]],
+) -> List[np.ndarray]:
+    """
+    Returns one vector per text in input order, calling `compute` only for
+    the texts that are not cached yet.
+    """
+    vectors = cache.get_many(texts)
+    misses = [t for t, v in zip(texts, vectors) if v is None]
+    if misses:
+        computed = await compute(misses)
+        cache.put_many(misses, computed)
+        it = iter(computed)
+        vectors = [v if v is not None else next(it) for v in vectors]
+    return vectors
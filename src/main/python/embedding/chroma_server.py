@@ -1,50 +1,178 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Literal, Optional, Dict, Any
+import asyncio
+import numpy as np
+import orjson
 import uvicorn
 import chromadb
 from sentence_transformers import SentenceTransformer
 import os
+import threading
+from batcher import DynamicBatcher
+from cache import EmbeddingCache, embed_with_cache
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Initialize Chroma client
 from chromadb.config import Settings
 from chromadb import PersistentClient
+from chromadb.errors import InvalidCollectionException
 
 PERSIST_DIR = "/chroma-data"
 
 client = PersistentClient(path=PERSIST_DIR)
 
 # Initialize OSS embedding model
-MODEL_NAME = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
-model = SentenceTransformer(MODEL_NAME)
+# Inference backend: "onnx" (default, INT8 quantized), "openvino", "torch" (FP32)
+# or "model2vec" (static embeddings, no transformer forward pass)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+
+DEFAULT_MODEL_NAME = (
+    "minishlab/potion-base-8M"
+    if EMBEDDING_BACKEND == "model2vec"
+    else "sentence-transformers/all-MiniLM-L6-v2"
+)
+MODEL_NAME = os.getenv("EMBEDDING_MODEL", DEFAULT_MODEL_NAME)
+
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+
+def load_model():
+    if EMBEDDING_BACKEND == "onnx":
+        return SentenceTransformer(
+            MODEL_NAME,
+            backend="onnx",
+            model_kwargs={"file_name": EMBEDDING_ONNX_FILE},
+        )
+    if EMBEDDING_BACKEND == "openvino":
+        return SentenceTransformer(MODEL_NAME, backend="openvino")
+    if EMBEDDING_BACKEND == "torch":
+        return SentenceTransformer(MODEL_NAME)
+    if EMBEDDING_BACKEND == "model2vec":
+        from model2vec import StaticModel
+        return StaticModel.from_pretrained(MODEL_NAME)
+    raise ValueError(f"Unknown EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+
+model = load_model()
+
+# Texts per transformer forward pass, grouped by token length to minimize padding
+ENCODE_BATCH_SIZE = int(os.getenv("EMBEDDING_ENCODE_BATCH_SIZE", "32"))
+
+if os.getenv("EMBEDDING_MAX_SEQ_LENGTH") and EMBEDDING_BACKEND != "model2vec":
+    model.max_seq_length = int(os.getenv("EMBEDDING_MAX_SEQ_LENGTH"))
+
+def encode_length_bucketed(texts: List[str]) -> np.ndarray:
+    # Sort by token length (SentenceTransformer only sorts by characters),
+    # encode each bucket as one padded batch, then restore input order.
+    token_ids = model.tokenizer(texts, add_special_tokens=False)["input_ids"]
+    order = np.argsort([len(ids) for ids in token_ids], kind="stable")
+    out = None
+    for start in range(0, len(order), ENCODE_BATCH_SIZE):
+        idx = order[start:start + ENCODE_BATCH_SIZE]
+        vecs = model.encode([texts[i] for i in idx], batch_size=ENCODE_BATCH_SIZE)
+        if out is None:
+            out = np.empty((len(texts), vecs.shape[1]), dtype=vecs.dtype)
+        out[idx] = vecs
+    return out
+
+# Coalesce concurrent /embed requests into one model.encode forward pass
+def encode_batch(texts: List[str]):
+    if EMBEDDING_BACKEND == "model2vec" or len(texts) <= ENCODE_BATCH_SIZE:
+        # Static embeddings have no padding cost; a single batch gains nothing
+        return model.encode(texts)
+    return encode_length_bucketed(texts)
+
+batcher = DynamicBatcher(
+    encode_batch,
+    max_batch_size=int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "64")),
+    timeout_ms=float(os.getenv("EMBEDDING_BATCH_TIMEOUT_MS", "5")),
+)
+
+# Repeated texts are served from an in-process LRU
+cache = EmbeddingCache(maxsize=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")))
 
 # Default non-empty metadata for Chroma collection (Chroma 0.4.x requires non-empty dict)
 DEFAULT_COLLECTION_METADATA = {
     "initialized": True
 }
 
+# Collection handles reused across requests (avoids a metadata lookup per call)
+_collections: Dict[str, Any] = {}
+_collections_lock = threading.Lock()
+
+def get_collection_cached(name: str):
+    with _collections_lock:
+        col = _collections.get(name)
+        if col is None:
+            col = client.get_or_create_collection(name=name, metadata=DEFAULT_COLLECTION_METADATA)
+            _collections[name] = col
+        return col
+
+def evict_collection(name: str):
+    with _collections_lock:
+        _collections.pop(name, None)
+
+def with_collection(name: str, op):
+    # A cached handle may point to a collection deleted behind our back;
+    # Chroma then raises InvalidCollectionException, so drop the handle and
+    # retry once with a fresh one.
+    try:
+        return op(get_collection_cached(name))
+    except InvalidCollectionException:
+        evict_collection(name)
+        return op(get_collection_cached(name))
+
+# Documents per collection.add call; keeps Chroma's write working set bounded
+ADD_BATCH_SIZE = int(os.getenv("CHROMA_ADD_BATCH_SIZE", "1000"))
+
+# int8 transport: each vector is sent as int8 codes plus one float scale
+# (v ~= codes * scale). Chroma itself stores float32, so vectors are
+# dequantized before add/query.
+def quantize_int8(vectors: np.ndarray):
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+def dequantize_int8(codes: List[List[float]], scales: List[float]) -> List[List[float]]:
+    if len(codes) != len(scales):
+        raise ValueError("embeddings and embedding scales must have the same length")
+    return (np.asarray(codes, dtype=np.float32) * np.asarray(scales, dtype=np.float32)[:, None]).tolist()
+
 # ---------- Models ----------
 class AddDocumentsRequest(BaseModel):
     ids: List[str]
     documents: List[str]
     metadatas: Optional[List[Dict[str, Any]]] = None
     embeddings: Optional[List[List[float]]] = None
+    # Present when embeddings are int8 codes (see quantize_int8)
+    embedding_scales: Optional[List[float]] = None
 
 class QueryRequest(BaseModel):
     query_texts: Optional[List[str]] = None
     query_embeddings: Optional[List[List[float]]] = None
+    query_embedding_scales: Optional[List[float]] = None
     n_results: int = 5
 
+    def resolved_query_embeddings(self) -> Optional[List[List[float]]]:
+        if self.query_embeddings is not None and self.query_embedding_scales is not None:
+            return dequantize_int8(self.query_embeddings, self.query_embedding_scales)
+        return self.query_embeddings
+
 class DeleteDocumentsRequest(BaseModel):
     ids: List[str]
 
 class EmbedRequest(BaseModel):
     texts: List[str]
+    # "float16" rounds vectors to half precision before they are returned;
+    # "int8" returns int8 codes with a per-vector scale in "scales"
+    dtype: Literal["float32", "float16", "int8"] = "float32"
 
 class EmbedResponse(BaseModel):
     vectors: List[List[float]]
+    dtype: str = "float32"
+    scales: Optional[List[float]] = None
 
 
 # ---------- Endpoints ----------
@@ -102,7 +230,7 @@ def collection_count(name: str):
 @app.post("/chroma/collections/{name}/create")
 def collection_create(name: str):
     try:
-        col = client.get_or_create_collection(name=name, metadata=DEFAULT_COLLECTION_METADATA)
+        col = get_collection_cached(name)
         return {"created": True, "error": None}
     except Exception as e:
         return {"created": False, "error": str(e)}
@@ -110,35 +238,51 @@ def collection_create(name: str):
 @app.delete("/chroma/collections/{name}")
 def collection_delete(name: str):
     try:
-        client.delete_collection(name=name)
+        # Delete and evict atomically so no concurrent request re-caches the old handle
+        with _collections_lock:
+            client.delete_collection(name=name)
+            _collections.pop(name, None)
         return {"deleted": True}
     except Exception as e:
         raise HTTPException(500, f"Delete failed: {e}")
 
 @app.post("/chroma/collections/{name}/add")
 def collection_add(name: str, req: AddDocumentsRequest):
+    # Writes are split into ADD_BATCH_SIZE batches and are not atomic: on error,
+    # "count" is the number of leading ids already stored; retry the rest.
+    committed = 0
     try:
-        col = client.get_or_create_collection(name=name, metadata=DEFAULT_COLLECTION_METADATA)
+        # Reject malformed input as a whole before the first batch is written
+        n = len(req.ids)
+        for field in ("documents", "metadatas", "embeddings", "embedding_scales"):
+            value = getattr(req, field)
+            if value is not None and len(value) != n:
+                raise ValueError(f"{field} has {len(value)} entries, expected {n} (one per id)")
         if req.metadatas is None:
             # Ensure metadata is never an empty dict (Chroma 0.4.x limitation)
             metadatas = [{"id": req.ids[i]} for i in range(len(req.ids))]
         else:
             metadatas = req.metadatas
-        col.add(
-            ids=req.ids,
-            documents=req.documents,
-            metadatas=metadatas,
-            embeddings=req.embeddings,
-        )
+        embeddings = req.embeddings
+        if embeddings is not None and req.embedding_scales is not None:
+            embeddings = dequantize_int8(embeddings, req.embedding_scales)
+        for start in range(0, len(req.ids), ADD_BATCH_SIZE):
+            end = start + ADD_BATCH_SIZE
+            with_collection(name, lambda col: col.add(
+                ids=req.ids[start:end],
+                documents=req.documents[start:end],
+                metadatas=metadatas[start:end],
+                embeddings=embeddings[start:end] if embeddings is not None else None,
+            ))
+            committed = min(end, len(req.ids))
         return {"status": "ok", "count": len(req.ids), "error": None}
     except Exception as e:
-        return {"status": "error", "count": 0, "error": str(e)}
+        return {"status": "error", "count": committed, "error": str(e)}
 
 @app.delete("/chroma/collections/{name}/delete")
 def collection_delete_docs(name: str, req: DeleteDocumentsRequest):
     try:
-        col = client.get_or_create_collection(name=name, metadata=DEFAULT_COLLECTION_METADATA)
-        col.delete(ids=req.ids)
+        with_collection(name, lambda col: col.delete(ids=req.ids))
         return {"deleted": len(req.ids), "error": None}
     except Exception as e:
         return {"deleted": 0, "error": str(e)}
@@ -146,24 +290,89 @@ def collection_delete_docs(name: str, req: DeleteDocumentsRequest):
 @app.post("/chroma/collections/{name}/query")
 def collection_query(name: str, req: QueryRequest):
     try:
-        col = client.get_or_create_collection(name=name, metadata=DEFAULT_COLLECTION_METADATA)
-        results = col.query(
+        query_embeddings = req.resolved_query_embeddings()
+        results = with_collection(name, lambda col: col.query(
             query_texts=req.query_texts,
-            query_embeddings=req.query_embeddings,
+            query_embeddings=query_embeddings,
             n_results=req.n_results,
-        )
+        ))
         return {"results": results}
     except Exception as e:
         return {"results": None, "error": str(e)}
 
+# Caps per-query threads across all streams so they cannot monopolize the
+# default executor that /embed batching also runs on
+QUERY_STREAM_CONCURRENCY = int(os.getenv("CHROMA_QUERY_STREAM_CONCURRENCY", "4"))
+_query_stream_slots = asyncio.Semaphore(QUERY_STREAM_CONCURRENCY)
+
+@app.post("/chroma/collections/{name}/query/stream")
+async def collection_query_stream(name: str, req: QueryRequest):
+    """
+    Same as /query, but runs each query text/vector separately and streams
+    one NDJSON line per query ({"index", "results", "error"}) as soon as it
+    completes, so lines may arrive out of input order.
+    """
+    try:
+        query_embeddings = req.resolved_query_embeddings()
+        n = len(query_embeddings or req.query_texts or [])
+        if n == 0:
+            raise ValueError("You must provide either query_texts or query_embeddings")
+    except Exception as e:
+        # Invalid input (mismatched scales, no queries): same error body as /query
+        return {"results": None, "error": str(e)}
+
+    def run_one(i: int):
+        return with_collection(name, lambda col: col.query(
+            query_texts=[req.query_texts[i]] if req.query_texts else None,
+            query_embeddings=[query_embeddings[i]] if query_embeddings else None,
+            n_results=req.n_results,
+        ))
+
+    async def run_indexed(i: int):
+        async with _query_stream_slots:
+            try:
+                return {"index": i, "results": await asyncio.to_thread(run_one, i), "error": None}
+            except Exception as e:
+                return {"index": i, "results": None, "error": str(e)}
+
+    async def lines():
+        tasks = [asyncio.create_task(run_indexed(i)) for i in range(n)]
+        try:
+            for done in asyncio.as_completed(tasks):
+                yield orjson.dumps(await done, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+        finally:
+            # Client went away (or generator closed): drop queries not yet started
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 @app.post("/embed", response_model=EmbedResponse)
-def embed(req: EmbedRequest):
+async def embed(req: EmbedRequest):
     if not req.texts:
-        return EmbedResponse(vectors=[])
-    embeddings = model.encode(req.texts, convert_to_numpy=True).tolist()
-    return EmbedResponse(vectors=embeddings)
+        return ORJSONResponse({"vectors": [], "dtype": req.dtype})
+    vectors = await embed_with_cache(cache, req.texts, batcher.submit)
+    # ORJSONResponse serializes the ndarray directly, without per-float Python objects
+    embeddings = np.stack(vectors)
+    if req.dtype == "int8":
+        codes, scales = quantize_int8(embeddings)
+        return ORJSONResponse({"vectors": codes, "dtype": "int8", "scales": scales})
+    embeddings = embeddings.astype(req.dtype, copy=False)
+    return ORJSONResponse({"vectors": embeddings, "dtype": req.dtype})
 
 
 # ---------- Main ----------
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8081)
+    # Workers default to 1: the embedded PersistentClient is not safe to share
+    # across processes, so only raise WEB_CONCURRENCY for read-only deployments.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    # Multiple workers need an import string; with one worker pass the app that
+    # is already loaded here so the model is not imported a second time.
+    uvicorn.run(
+        "chroma_server:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=8081,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+    )
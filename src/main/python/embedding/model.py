@@ -1,25 +1,80 @@
 import numpy as np
-import hashlib
+import xxhash
+from functools import lru_cache
 
 EMBED_DIM = 128
 
-def compute_embedding(text: str) -> list[float]:
+# xxh3_128 は 16 バイトなので、seed を変えて EMBED_DIM バイト分を連結する
+_DIGEST_SIZE = 16
+_SEEDS = range(EMBED_DIM // _DIGEST_SIZE)
+
+# 語彙はコーパス全体で再利用されるため、単語ごとのハッシュをキャッシュする
+@lru_cache(maxsize=1 << 16)
+def _token_digest(token: str) -> bytes:
+    data = token.encode("utf-8")
+    return b"".join(xxhash.xxh3_128_digest(data, seed=s) for s in _SEEDS)
+
+def _accumulate_numpy(arr: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+    # テキスト境界 (単語数の累積) で prefix sum を差し引く
+    prefix = np.zeros((arr.shape[0] + 1, EMBED_DIM), dtype=np.int64)
+    np.cumsum(arr, axis=0, out=prefix[1:])
+    return (prefix[bounds[1:]] - prefix[bounds[:-1]]).astype(np.float32)
+
+def _accumulate_numba(arr: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+    # uint8 を直接 float32 に加算する 1 パスのループ (prefix 配列不要)
+    out = np.zeros((bounds.shape[0] - 1, arr.shape[1]), dtype=np.float32)
+    for t in range(out.shape[0]):
+        for i in range(bounds[t], bounds[t + 1]):
+            for j in range(arr.shape[1]):
+                out[t, j] += arr[i, j]
+    return out
+
+# numba がインストールされていれば JIT 版を使う (optional。requirements には含めない)
+# compute_embeddings は np.frombuffer の読み取り専用配列を渡すので、
+# ウォームアップも読み取り専用配列で行い同じ特殊化をコンパイルしておく
+try:
+    from numba import njit
+except ImportError:
+    _accumulate = _accumulate_numpy
+else:
+    _accumulate = njit(cache=True)(_accumulate_numba)
+    _accumulate(
+        np.frombuffer(bytes(EMBED_DIM), dtype=np.uint8).reshape(1, EMBED_DIM),
+        np.array([0, 1], dtype=np.int64),
+    )
+
+def compute_embeddings(texts: list[str]) -> np.ndarray:
     """
-    Lightweight OSS embedding:
-    - SHA256 により単語ごとにハッシュ
-    - 128 次元に落とし込み
+    Lightweight OSS embedding (batch):
+    - xxh3_128 (非暗号学的ハッシュ) により単語ごとに 128 バイトのハッシュ
+    - 全テキストの単語を 1 つのバッファにまとめ、累積和でテキストごとに集計
     - L2 normalize
+    戻り値は (len(texts), EMBED_DIM) の float32 配列
     """
-    vec = np.zeros(EMBED_DIM, dtype=np.float32)
+    # str.split は全角スペース等の Unicode 空白でも分割する (bytes.split は ASCII のみ)。
+    # UTF-8 エンコードは _token_digest のキャッシュミス時だけなので str のまま扱う
+    token_lists = [text.split() for text in texts]
+    digests = b"".join(
+        _token_digest(token)
+        for tokens in token_lists
+        for token in tokens
+    )
+    arr = np.frombuffer(digests, dtype=np.uint8).reshape(-1, EMBED_DIM)
 
-    for token in text.split():
-        h = hashlib.sha256(token.encode("utf-8")).digest()
-        for i in range(EMBED_DIM):
-            vec[i] += h[i] / 255.0
+    bounds = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(tokens) for tokens in token_lists], out=bounds[1:])
+    vecs = _accumulate(arr, bounds)
+    vecs *= np.float32(1.0 / 255.0)
 
     # L2 normalize
-    norm = np.linalg.norm(vec)
-    if norm > 0:
-        vec /= norm
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    vecs /= norms
+
+    return vecs
 
-    return vec.tolist()
+def compute_embedding(text: str) -> list[float]:
+    """
+    Lightweight OSS embedding (single text). See compute_embeddings.
+    """
+    return compute_embeddings([text])[0].tolist()